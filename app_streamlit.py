@@ -17,10 +17,21 @@ from docx.table import _Cell, Table
 from docx.text.paragraph import Paragraph
 from docx.oxml.table import CT_Tbl
 from docx.oxml.text.paragraph import CT_P
-import base64
+import hashlib
 from docx.text.run import Run
 from docx.oxml.ns import qn
+from utils.html_soup import make_soup
+from utils.text import strip_accents, html_escape as _html_escape, data_url
 import difflib
+from functools import lru_cache
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# st.fragment (Streamlit >= 1.37), sinon l'API expérimentale, sinon appel normal
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
 
 # ================= CONFIGURATION =================
 HEADING_STYLES = {"Heading 1","Heading 2","Heading 3","Titre 1","Titre 2","Titre 3","Title","Subtitle"}
@@ -40,6 +51,23 @@ _BULLETS = "•◦◘▪▫·—–-o" + NBSP
 _BULLET_CLASS = "".join(re.escape(ch) for ch in _BULLETS)
 BULLET_ONLY_RE = re.compile(r'^[\s' + _BULLET_CLASS + r']+$', re.I)
 
+_WS_RE = re.compile(r"\s+")
+_LEADING_NUMBERING_RE = re.compile(r'^\s*(?:[\(\[]?\d+(?:\.\d+)*[\)\.]?|[ivxlcdm]+[\)\.]|[A-Z]\)|•|—|-)\s*', re.I)
+# variante appliquée après lower() (sans re.I) dans fix_section_numbering
+_LABEL_NUMBERING_RE = re.compile(r'^\s*(?:[\(\[]?\d+(?:\.\d+)*[\)\.]?|[ivxlcdm]+[\)\.]|[A-Z]\)|•|–|—|-|\*)\s*')
+_SIMPLE_NUM_RE = re.compile(r'^\s*(?:\d+[\.\)]\s*)')
+_FINAL_PUNCT = (".", "!", "?")
+_IA_DISCLAIMER_RE = re.compile(r"le contenu\s+g[éè]n[éè]r[éè]\s+par l[''' ]?ia\s+peut\s+être\s+incorrect\.?", re.I)
+_DL_TOKEN_RE = re.compile(r'<!--DL:([0-9a-f]+)-->', re.I)
+# une ligne vide termine un bloc HTML brut en Markdown
+_BLANK_LINES_RE = re.compile(r"\n\s*\n")
+_PRIX_DE_REVIENT_RE = re.compile(r'\bprix\s*de\s*reven[ti]\b', re.I)
+_PRIX_DE_REVIENT_TITLE_RE = re.compile(r'(?:^|>)\s*1\.\s*prix\s*de\s*reven[ti]', re.I)
+_ORPHAN_PRIX_RE = re.compile(r'<(?:p|span|em|u|strong|a)[^>]*>\s*prix\s*de\s*reven[ti]\s*</(?:p|span|em|u|strong|a)>', re.I)
+_ORPHAN_PRIX_WS_RE = re.compile(_ORPHAN_PRIX_RE.pattern + r'\s*', re.I)
+_DOTTED_NUM_RE = re.compile(r'^\s*\d+\.\s*')
+_LABEL_HOLDER_TAGS = frozenset({"h1","h2","h3","p","li","strong","b","em","i","u","span","td","th"})
+
 SCHEMA_PATH = Path("crm_schema.yaml")
 MAP_PATH = Path("heading_map.yaml")
 
@@ -102,37 +130,76 @@ KEYWORD_TO_WH = {
     "finance": "Finances",
 }
 
+# Titres de section reconnus par _is_section_heading_p (texte normalisé, sans numérotation)
+_KNOWN_SECTION_TITLES = frozenset({
+    "introduction","description",
+    "contexte et usage des fonds",
+    "facteurs de risque",
+    "les bonnes raisons d investir",
+    "presentation de l operation",
+    "localisation",
+    "administratif et timing","planning",
+    "marche et references",
+    "budget de l operation","budget",
+    "l operateur",
+    "track record et operations en cours","track record",
+    "structure et management",
+    "actionnariat et structure de l operation","actionnariat",
+    "finances","finance"
+})
+
+# Titres imposés (et leur ordre) par fix_section_numbering
+FIXED_SECTION_TITLES = {
+    'points_attention_fr': [
+        "Risque lié au projet",
+        "Risque lié au secteur",
+        "Risque de défaut",
+    ],
+    'bonnes_raisons_fr': [
+        "Une assurance sur 100% du capital investi",
+        "Une fiducie-sûreté sur l'actif",
+    ],
+    'budget_fr': [
+        "Prix de revient",
+        "Financement et ratios",
+        "Revenus et marges",
+        "Couverture des intérêts",
+        "Stress test",
+    ],
+}
+
 # ================= FONCTIONS UTILITAIRES =================
         
-def _strip_accents(x: str) -> str:
-    if x is None: return ""
-    try:
-        import unicodedata
-        nfkd = unicodedata.normalize("NFKD", x)
-        return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
-    except Exception:
-        return x
-
+_strip_accents = lru_cache(maxsize=4096)(strip_accents)
+
+# Tables de ponctuation construites une fois (et non à chaque appel)
+_NORM_PUNCT_TABLE = str.maketrans({
+    "\u00A0": " ",  # NBSP -> espace
+    "\u2019": "'",  # apostrophe courbe -> '
+    "\u2018": "'",
+    "\u2032": "'",
+    "\u201C": '"',  # guillemets courbes -> "
+    "\u201D": '"',
+    "\u2013": "-",  # en dash/em dash/minus -> -
+    "\u2014": "-",
+    "\u2212": "-",
+})
+_LABEL_PUNCT_TABLE = str.maketrans({"\u00A0":" ", "’":"'","‘":"'", "“":'"',"”":'"', "–":"-","—":"-","−":"-"})
+
+@lru_cache(maxsize=4096)
 def _norm(s: str) -> str:
     s = (s or "")
+    # déjà normalisé (ASCII, minuscules, espaces simples) : rien à faire
+    if s.isascii() and s.islower() and " ".join(s.split()) == s:
+        return s
     # Normaliser espaces & ponctuation “exotiques”
-    s = s.replace("\u00A0", " ")  # NBSP -> espace
-    s = s.translate(str.maketrans({
-        "\u2019": "'",  # apostrophe courbe -> '
-        "\u2018": "'",
-        "\u2032": "'",
-        "\u201C": '"',  # guillemets courbes -> "
-        "\u201D": '"',
-        "\u2013": "-",  # en dash/em dash/minus -> -
-        "\u2014": "-",
-        "\u2212": "-",
-    }))
-    s = re.sub(r"\s+", " ", s).strip()
+    s = s.translate(_NORM_PUNCT_TABLE)
+    s = _WS_RE.sub(" ", s).strip()
     s = _strip_accents(s).lower()
     return s
 
 def _strip_leading_numbering(s: str) -> str:
-    return re.sub(r'^\s*(?:[\(\[]?\d+(?:\.\d+)*[\)\.]?|[ivxlcdm]+[\)\.]|[A-Z]\)|•|—|-)\s*', '', s or '', flags=re.I)
+    return _LEADING_NUMBERING_RE.sub('', s or '')
 
 def _is_bullet_only_text(text: str) -> bool:
     t = (text or "").replace(NBSP, " ").strip()
@@ -151,31 +218,11 @@ def _is_section_heading_p(p: Tag) -> bool:
 
     norm_txt = _norm(_strip_leading_numbering(txt)).rstrip(" :")
 
-    KNOWN_EQUALS = {
-        "introduction","description",
-        "contexte et usage des fonds",
-        "facteurs de risque",
-        "les bonnes raisons d investir",
-        "presentation de l operation",
-        "localisation",
-        "administratif et timing","planning",
-        "marche et references",
-        "budget de l operation","budget",
-        "l operateur",
-        "track record et operations en cours","track record",
-        "structure et management",
-        "actionnariat et structure de l operation","actionnariat",
-        "finances","finance"
-    }
     # p tout en gras ? on n'exige pas forcément, mais on reste sur égalité stricte
-    return norm_txt in KNOWN_EQUALS
-
-def _html_escape(s: str) -> str:
-    return (s or "").replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
-
-def strip_leading_title_block(html: str) -> str:
-    soup = BeautifulSoup(f"<div>{html}</div>", "html.parser")
+    return norm_txt in _KNOWN_SECTION_TITLES
 
+def _drop_leading_title_block(soup: BeautifulSoup) -> None:
+    """Supprime (en place) le bloc-titre plaqué en tête de soup.div."""
     # sauter les nœuds vides/espaces au tout début
     def _iter_first_blocks():
         for child in soup.div.children:
@@ -198,7 +245,7 @@ def strip_leading_title_block(html: str) -> str:
 
             # (b) Ligne courte avec tiret long/court (pattern "Nom – Lieu"), pas de point final
             has_dash = (" - " in t) or (" – " in t)
-            short_line = len(t) <= 120 and has_dash and not re.search(r"[\.!?]$", t)
+            short_line = len(t) <= 120 and has_dash and not t.endswith(_FINAL_PUNCT)
 
             # (c) Ligne strictement en gras (un seul enfant <strong>/<b>) et courte
             is_strong_only = (len(child.contents) == 1 and getattr(child.contents[0], "name", None) in {"strong","b"} and len(t) <= 120)
@@ -207,11 +254,9 @@ def strip_leading_title_block(html: str) -> str:
                 child.decompose()
             break
 
-    return soup.div.decode_contents()
-
 # ================= GESTION DES IMAGES =================
 
-def _image_handler(image) -> dict:
+def _image_handler(image, img_store: dict, url_cache: dict) -> dict:
     ctype = (getattr(image, "content_type", None) or "application/octet-stream").lower()
     try:
         with image.open() as f:
@@ -220,12 +265,9 @@ def _image_handler(image) -> dict:
         data = b""
 
     if ctype in ("image/x-emf", "image/emf", "image/x-wmf", "image/wmf", "application/octet-stream"):
-        import uuid, base64
         uid = uuid.uuid4().hex
         fname = f"{uid}.{'emf' if 'emf' in ctype else ('wmf' if 'wmf' in ctype else 'bin')}"
-        if "img_store" not in st.session_state:
-            st.session_state["img_store"] = {}
-        st.session_state["img_store"][uid] = (fname, data, ctype)
+        img_store[uid] = (fname, data, ctype)
 
         # pixel transparent + marqueurs pour qu’on sache générer un bouton plus tard
         return {
@@ -235,13 +277,20 @@ def _image_handler(image) -> dict:
             "data-uid": uid,
         }
 
-    import base64
-    b64 = base64.b64encode(data).decode("ascii")
-    return {"src": f"data:{ctype};base64,{b64}"}
+    # même image répétée (logo, pictogramme) : encodée une seule fois par document
+    key = (ctype, data)
+    src = url_cache.get(key)
+    if src is None:
+        src = url_cache[key] = data_url(ctype, data)
+    return {"src": src}
 
 # ================= CONVERSION DOCX -> HTML =================
 
-def docx_to_html(path: str) -> str:
+def docx_to_html(file_bytes: bytes) -> tuple[str, dict]:
+    """
+    Convertit le .docx en HTML. Renvoie aussi les images EMF/WMF mises de côté
+    (uid -> (fname, data, ctype)) pour les boutons de téléchargement.
+    """
     style_map = """
 p[style-name='Heading 1'] => h1:fresh
 p[style-name='Heading 2'] => h2:fresh
@@ -250,13 +299,20 @@ p[style-name='Titre 1']   => h1:fresh
 p[style-name='Titre 2']   => h2:fresh
 p[style-name='Titre 3']   => h3:fresh
 """
-    with open(path, "rb") as f:
-        result = mammoth.convert_to_html(
-            f,
-            convert_image=mammoth.images.inline(_image_handler),
-            style_map=style_map
-        )
-    return result.value
+    img_store: dict = {}
+    url_cache: dict = {}
+    result = mammoth.convert_to_html(
+        io.BytesIO(file_bytes),
+        convert_image=mammoth.images.inline(lambda image: _image_handler(image, img_store, url_cache)),
+        style_map=style_map
+    )
+    return result.value, img_store
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def docx_to_html_cached(content_hash: str, _file_bytes: bytes) -> tuple[str, dict]:
+    # clé = empreinte du fichier (le "_" exclut les octets du hachage Streamlit) :
+    # un rerun sans nouvel upload ne relance pas Mammoth et ne re-hache pas le fichier
+    return docx_to_html(_file_bytes)
 
 # ================= DÉCOUPAGE PAR SECTIONS =================
 
@@ -279,6 +335,7 @@ def build_heading_index(expected_headings: list[str], word_to_pdf: dict[str, str
     idx[_norm("finances")] = "Finances"
     return idx
 
+@st.cache_data(show_spinner=False, max_entries=4)
 def split_sections_by_headings(html: str, heading_index: dict[str, str]) -> dict[str, str]:
     """
     Découpage conservateur et déterministe (style v22) :
@@ -289,13 +346,16 @@ def split_sections_by_headings(html: str, heading_index: dict[str, str]) -> dict
     def nrm(s: str) -> str:
         return _norm(_strip_leading_numbering((s or "")).rstrip(" :"))
 
-    soup = BeautifulSoup(f"<div>{html}</div>", "html.parser")
-    out = {v: "" for v in set(heading_index.values())}
+    soup = make_soup(f"<div>{html}</div>")
+    nodes: dict[str, list] = {v: [] for v in set(heading_index.values())}
 
-    # Pré-scan : repérer les titres visibles
+    # Pré-scan : repérer les titres visibles (texte + forme normalisée gardés pour le parcours)
     present_titles = set()
+    scanned = {}
     for el in soup.find_all(["h1","h2","h3","p"]):
-        t = nrm(el.get_text(" ", strip=True))
+        text = el.get_text(" ", strip=True)
+        t = nrm(text)
+        scanned[id(el)] = (text, t)
         if t in heading_index:
             present_titles.add(heading_index[t])
 
@@ -306,18 +366,15 @@ def split_sections_by_headings(html: str, heading_index: dict[str, str]) -> dict
         if not hasattr(el, "get_text"):
             continue
 
-        name = getattr(el, "name", None)
-        text = el.get_text(" ", strip=True) if name in {"h1","h2","h3","p"} else ""
+        text, norm_text = scanned.get(id(el), ("", ""))
         key = None
 
-        if text:
-            norm_text = nrm(text)
-            if norm_text in heading_index:
-                wh = heading_index[norm_text]   # Titre Word
-                # ignorer 'Projet' si 'Présentation...' est présent
-                if ignore_projet and wh == "Projet":
-                    wh = None
-                key = wh
+        if text and norm_text in heading_index:
+            wh = heading_index[norm_text]   # Titre Word
+            # ignorer 'Projet' si 'Présentation...' est présent
+            if ignore_projet and wh == "Projet":
+                wh = None
+            key = wh
 
         if key:
             current = key
@@ -327,36 +384,40 @@ def split_sections_by_headings(html: str, heading_index: dict[str, str]) -> dict
         if current is None and text:
             current = "Introduction"
 
-        if current in out:
-            out[current] += str(el)
+        if current in nodes:
+            nodes[current].append(el)
 
+    # sérialisation unique par section
+    out = {k: "".join(str(el) for el in els) for k, els in nodes.items()}
     return out
 
 # ================= NETTOYAGE DES LISTES =================
 
 def _fix_lists_in_soup(soup):
-    changed = True
-    while changed:
-        changed = False
+    # 1) Nettoyage du texte : un seul passage suffit. Les <p> vides sous <li>
+    #    sont retirés AVANT le test des <li> vides, qui voit donc l'état final.
+    # Retire <p> "puces seules"
+    for p in list(soup.find_all("p")):
+        if _is_bullet_only_text(p.get_text(" ", strip=True)):
+            p.decompose()
 
-        # Retire <p> ou <li> "puces seules" / vides
-        for p in list(soup.find_all("p")):
-            if _is_bullet_only_text(p.get_text(" ", strip=True)):
+    # Nettoie <p> vides directement sous <li>
+    for li in list(soup.find_all("li")):
+        for p in list(li.find_all("p", recursive=False)):
+            if not p.get_text(strip=True):
                 p.decompose()
-                changed = True
 
-        for li in list(soup.find_all("li")):
-            txt = li.get_text(" ", strip=True)
-            if not txt or _is_bullet_only_text(txt):
-                li.decompose()
-                changed = True
+    # Retire <li> "puces seules" / vides
+    for li in list(soup.find_all("li")):
+        txt = li.get_text(" ", strip=True)
+        if not txt or _is_bullet_only_text(txt):
+            li.decompose()
 
-        # Nettoie <p> vides directement sous <li>
-        for li in list(soup.find_all("li")):
-            for p in list(li.find_all("p", recursive=False)):
-                if not p.get_text(strip=True):
-                    p.decompose()
-                    changed = True
+    # 2) Restructuration : ne déplace que des nœuds non vides, on itère
+    #    seulement tant qu'elle modifie l'arbre
+    changed = True
+    while changed:
+        changed = False
 
         # Aplatis quelques cas simples (li sans texte direct + une seule sous-liste)
         for li in list(soup.find_all("li")):
@@ -379,8 +440,7 @@ def _fix_lists_in_soup(soup):
 
         # Supprime <ul> sans <li> qui ne contiennent qu'une sous-liste
         for ul in list(soup.find_all("ul")):
-            lis = ul.find_all("li", recursive=False)
-            if len(lis) == 0:
+            if ul.find("li", recursive=False) is None:
                 only_lists = [c for c in ul.contents if getattr(c, "name", None) in ("ol", "ul")]
                 if len(only_lists) == 1:
                     ul.replace_with(only_lists[0])
@@ -390,18 +450,20 @@ def _fix_lists_in_soup(soup):
 
 # ================= PRÉPARATION FINALE DES SECTIONS =================
 
-def prepare_section_html(html: str):
-    soup = BeautifulSoup(f"<div>{html}</div>", "html.parser")
+def prepare_section_html(html: str, strip_title: bool = False):
+    soup = make_soup(f"<div>{html}</div>")
     downloads = []
 
-    IA_PAT = re.compile(r"le contenu\s+g[éè]n[éè]r[éè]\s+par l[''' ]?ia\s+peut\s+être\s+incorrect\.?", re.I)
-    for p in list(soup.find_all("p")):
-        if IA_PAT.search(p.get_text(" ", strip=True)):
-            p.decompose()
+    # même arbre que le nettoyage : évite un parse/sérialisation de plus pour Description
+    if strip_title:
+        _drop_leading_title_block(soup)
 
-    for img in list(soup.find_all("img")):
-        if img.get("data-unsupported") != "1" and img.has_attr("alt"):
-            del img["alt"]
+    # le texte d'un <p> est une sous-chaîne contiguë du texte de la section :
+    # pas de correspondance globale => aucun <p> à examiner
+    if _IA_DISCLAIMER_RE.search(soup.div.get_text(" ", strip=True)):
+        for p in list(soup.find_all("p")):
+            if _IA_DISCLAIMER_RE.search(p.get_text(" ", strip=True)):
+                p.decompose()
 
     for p in list(soup.find_all("p")):
         if len(p.contents) == 1 and getattr(p.contents[0], "name", None) in ("strong", "b"):
@@ -411,9 +473,13 @@ def prepare_section_html(html: str):
     #for cont in soup.find_all(["div", "section"]):
         #_convert_numbered_paragraphs_to_ol(cont)
 
-    # récupérer les EMF/WMF stockées durant la conversion
+    # un seul parcours des <img> : alt retiré des images affichables,
+    # EMF/WMF stockées durant la conversion récupérées
     for img in list(soup.find_all("img")):
-        if img.get("data-unsupported") == "1":
+        if img.get("data-unsupported") != "1":
+            if img.has_attr("alt"):
+                del img["alt"]
+        else:
             uid = img.get("data-uid")
             if uid and "img_store" in st.session_state and uid in st.session_state["img_store"]:
                 fname, data, ctype = st.session_state["img_store"][uid]
@@ -426,7 +492,7 @@ def prepare_section_html(html: str):
     _fix_lists_in_soup(soup)
 
     cleaned = soup.div.decode_contents()
-    cleaned = re.sub(r"(?is)le contenu\s+g[éè]n[éè]r[éè]\s+par l[''' ]?ia\s+peut\s+être\s+incorrect\.?", '', cleaned)
+    cleaned = _IA_DISCLAIMER_RE.sub('', cleaned)
 
     return cleaned, downloads
 
@@ -441,18 +507,11 @@ def force_budget_structure(html: str) -> str:
     if not html or not html.strip():
         return "<p data-fixed-title='1'><em><u>1. Prix de revient</u></em></p>"
 
-    import re, unicodedata
-    from bs4 import BeautifulSoup, NavigableString
-
-    def _strip_acc(s: str) -> str:
-        return "".join(ch for ch in unicodedata.normalize("NFKD", s or "") if not unicodedata.combining(ch))
-
     def nrm(s: str) -> str:
-        s = (s or "").replace("\u00A0"," ")
-        s = s.translate(str.maketrans({"’":"'","‘":"'", "“":'"',"”":'"', "–":"-","—":"-","−":"-"}))
-        s = re.sub(r"\s+", " ", s).strip()
-        s = _strip_acc(s).lower().rstrip(" :")
-        s = re.sub(r'^\s*(?:\d+[\.\)]\s*)', '', s)  # retire un "2." éventuel
+        s = (s or "").translate(_LABEL_PUNCT_TABLE)
+        s = _WS_RE.sub(" ", s).strip()
+        s = _strip_accents(s).lower().rstrip(" :")
+        s = _SIMPLE_NUM_RE.sub('', s)  # retire un "2." éventuel
         return s
 
     ANCHORS = [
@@ -465,8 +524,10 @@ def force_budget_structure(html: str) -> str:
         ("Stress test",           {"stress test"}),
     ]
     anchor_keys = set().union(*[keys for _, keys in ANCHORS])
+    prix_key = nrm("Prix de revient")
+    prix_head_keys = {nrm("prix de revient"), nrm("1. prix de revient")}
 
-    soup = BeautifulSoup(f"<div>{html}</div>", "html.parser")
+    soup = make_soup(f"<div>{html}</div>")
     children = [el for el in soup.div.children
                 if (getattr(el, "name", None) is not None) or
                    (isinstance(el, NavigableString) and str(el).strip())]
@@ -478,8 +539,7 @@ def force_budget_structure(html: str) -> str:
     def _is_head_prix_de_revient(el):
         if getattr(el, "name", None) != "p":
             return False
-        t = nrm(_txt(el))
-        return t == nrm("prix de revient") or t == nrm("1. prix de revient")
+        return nrm(_txt(el)) in prix_head_keys
     
     drop = 0
     for i, el in enumerate(children):
@@ -516,7 +576,7 @@ def force_budget_structure(html: str) -> str:
         if name == "p":
             txt = (el.get_text(" ", strip=True) or "")
             # légende courte, pas de ponctuation finale forte
-            if txt and len(txt) <= 150 and not re.search(r"[\.!?]$", txt):
+            if txt and len(txt) <= 150 and not txt.endswith(_FINAL_PUNCT):
                 nxt = _next_sig(i)
                 nxt_name = getattr(nxt, "name", None)
                 if nxt_name in {"table", "figure"} or (nxt_name == "p" and nxt and nxt.find("table") is not None):
@@ -533,58 +593,50 @@ def force_budget_structure(html: str) -> str:
     def node_text(el):
         return (el.get_text(" ", strip=True) if hasattr(el, "get_text") else str(el)).strip()
 
-    def anchor_of(el):
-        t = nrm(node_text(el))
-        for title, keys in ANCHORS:
-            if t in keys:
-                return title
-        return None
+    # texte normalisé calculé une seule fois par bloc (ancres + filtrage des doublons)
+    work_norms = [nrm(node_text(el)) for el in work]
+    anchor_by_key = {k: title for title, keys in ANCHORS for k in keys}
 
     anchor_pos = {}
-    for idx, el in enumerate(work):
-        t = anchor_of(el)
-        if t and t not in anchor_pos:
-            anchor_pos[t] = idx
+    for idx, t in enumerate(work_norms):
+        title = anchor_by_key.get(t)
+        if title and title not in anchor_pos:
+            anchor_pos[title] = idx
 
     ordered = [t for t,_ in ANCHORS if t in anchor_pos]
     ordered.sort(key=lambda t: anchor_pos[t])
 
-    # 3) Tranches : tout avant la 1ʳᵉ ancre = Prix de revient
+    # 3) Tranches (bornes dans work) : tout avant la 1ʳᵉ ancre = Prix de revient
     slices = []
     if ordered:
         first_pos = anchor_pos[ordered[0]]
-        slices.append(("Prix de revient", work[:first_pos]))
+        slices.append(("Prix de revient", 0, first_pos))
         for j, title in enumerate(ordered):
             p = anchor_pos[title]
             q = anchor_pos[ordered[j+1]] if j+1 < len(ordered) else len(work)
-            slices.append((title, work[p+1:q]))  # saute la ligne-ancre elle-même
+            slices.append((title, p+1, q))  # saute la ligne-ancre elle-même
     else:
-        slices.append(("Prix de revient", work))
+        slices.append(("Prix de revient", 0, len(work)))
 
     # 4) Assembler : KPI -> 1. Prix de revient -> 2/3/4/5 sans réinjecter les titres bruts
     out = []
     out.extend(str(el) for el in lead_blocks)
 
-    def is_pure_title(el):
-        t = nrm(node_text(el))
-        return (t in anchor_keys) or (t == nrm("Prix de revient"))
+    def is_pure_title(t):
+        return (t in anchor_keys) or (t == prix_key)
 
     num = {"Prix de revient":1,"Financement et ratios":2,"Revenus et marges":3,"Couverture des intérêts":4,"Stress test":5}
-    for title, chunk in slices:
+    for title, start, end in slices:
         if title not in num: continue
         out.append(f"<p data-fixed-title='1'><em><u>{num[title]}. {title}</u></em></p>")
-        for el in chunk:
-            if is_pure_title(el):  # évite les doublons
+        for k in range(start, end):
+            if is_pure_title(work_norms[k]):  # évite les doublons
                 continue
-            out.append(str(el))
+            out.append(str(work[k]))
 
     # 5) Nettoyage d'une éventuelle ligne 'Prix de revient' orpheline
     res = "".join(out)
-    res = re.sub(
-        r'<(?:p|span|em|u|strong|a)[^>]*>\s*prix\s*de\s*reven[ti]\s*</(?:p|span|em|u|strong|a)>\s*',
-        '',
-        res, flags=re.I
-    )
+    res = _ORPHAN_PRIX_WS_RE.sub('', res)
     return res
 
 # ================= CORRECTION DE LA NUMÉROTATION =================
@@ -608,43 +660,21 @@ def fix_section_numbering(html: str, section_key: str) -> str:
     if not html or not html.strip():
         return html
 
-    soup = BeautifulSoup(f"<div>{html}</div>", "html.parser")
-
-    EXPECTED = {
-        'points_attention_fr': [
-            "Risque lié au projet",
-            "Risque lié au secteur",
-            "Risque de défaut",
-        ],
-        'bonnes_raisons_fr': [
-            "Une assurance sur 100% du capital investi",
-            "Une fiducie-sûreté sur l'actif",
-        ],
-        'budget_fr': [
-            "Prix de revient",
-            "Financement et ratios",
-            "Revenus et marges",
-            "Couverture des intérêts",
-            "Stress test",
-        ],
-    }
-    if section_key not in EXPECTED:
+    if section_key not in FIXED_SECTION_TITLES:
         return html
 
-    # -------- normalisations --------
-    def _strip_acc(s: str) -> str:
-        import unicodedata
-        return "".join(ch for ch in unicodedata.normalize("NFKD", s or "") if not unicodedata.combining(ch))
+    # parse seulement pour les sections concernées
+    soup = make_soup(f"<div>{html}</div>")
 
+    # -------- normalisations --------
     def nrm(s: str) -> str:
-        s = (s or "").replace("\u00A0", " ")
-        s = s.translate(str.maketrans({"’":"'","‘":"'", "“":'"',"”":'"', "–":"-","—":"-","−":"-"}))
-        s = re.sub(r"\s+", " ", s).strip()
-        s = _strip_acc(s).lower()
-        s = re.sub(r'^\s*(?:[\(\[]?\d+(?:\.\d+)*[\)\.]?|[ivxlcdm]+[\)\.]|[A-Z]\)|•|–|—|-|\*)\s*', '', s)
+        s = (s or "").translate(_LABEL_PUNCT_TABLE)
+        s = _WS_RE.sub(" ", s).strip()
+        s = _strip_accents(s).lower()
+        s = _LABEL_NUMBERING_RE.sub('', s)
         return s.rstrip(" :")
 
-    expected = list(EXPECTED[section_key])
+    expected = list(FIXED_SECTION_TITLES[section_key])
     expected_map = { nrm(lbl): lbl for lbl in expected }
     if section_key == 'budget_fr':
         expected_map[nrm("Couvertures des intérêts")] = "Couverture des intérêts"
@@ -656,30 +686,45 @@ def fix_section_numbering(html: str, section_key: str) -> str:
 
     # -------- 1) repérer la 1ʳᵉ occurrence de chaque libellé (incl. TEXTES NUS) --------
     first = {}
+    n_labels = len(set(expected_map.values()))
+
+    # une alternative ancrée par libellé encore libre, dans l'ordre d'expected_map :
+    # un seul match() remplace la boucle de startswith ; recompilée à chaque libellé trouvé
+    def _pending_matcher():
+        pending = [(pat, canon) for pat, canon in expected_map.items() if canon not in first]
+        rx = re.compile("|".join(f"({re.escape(pat)})" for pat, _ in pending)) if pending else None
+        return rx, [canon for _, canon in pending]
+
+    label_re, label_canons = _pending_matcher()
     for node in soup.div.descendants:
+        if len(first) == n_labels:  # tous les libellés trouvés : inutile de continuer
+            break
+        # enfant unique d'une balise déjà examinée (texte ou <p>/<strong>… imbriqué) :
+        # même texte, même verdict -> pas de get_text ni de normalisation
+        parent = node.parent
+        if parent is not None and parent.name in _LABEL_HOLDER_TAGS and len(parent.contents) == 1:
+            continue
         if isinstance(node, NavigableString):
             txt = (str(node) or "").strip()
-            if not txt or len(txt) > 180:  # on ignore les très longues lignes
-                continue
-            key = nrm(txt)
-            for pat, canon in expected_map.items():
-                if key.startswith(pat) and canon not in first:
-                    holder = node.find_parent(["p","li","td","th"]) or node
-                    first[canon] = holder
-                    break
-        elif isinstance(node, Tag) and node.name in ['h1','h2','h3','p','li','strong','b','em','i','u','span','td','th']:
+        elif isinstance(node, Tag) and node.name in _LABEL_HOLDER_TAGS:
             txt = node.get_text(" ", strip=True)
-            if not txt or len(txt) > 180:
-                continue
-            key = nrm(txt)
-            for pat, canon in expected_map.items():
-                if key.startswith(pat) and canon not in first:
-                    first[canon] = node
-                    break
+        else:
+            continue
+        if not txt or len(txt) > 180:  # on ignore les très longues lignes
+            continue
+        key = nrm(txt)  # une seule normalisation par nœud
+        m = label_re.match(key) if label_re else None
+        if m:
+            canon = label_canons[m.lastindex - 1]
+            if isinstance(node, NavigableString):
+                first[canon] = node.find_parent(["p","li","td","th"]) or node
+            else:
+                first[canon] = node
+            label_re, label_canons = _pending_matcher()
 
     # secours “Prix de revient” s’il n’est pas trouvé (cas texte nu après tableau)
     if section_key == 'budget_fr' and "Prix de revient" not in first:
-        m = soup.find(string=re.compile(r'(?i)\bprix\s*de\s*reven[ti]\b'))
+        m = soup.find(string=_PRIX_DE_REVIENT_RE)
         if m:
             first["Prix de revient"] = m.find_parent(["p","li","td","th"]) or m
         else:
@@ -763,7 +808,7 @@ def fix_section_numbering(html: str, section_key: str) -> str:
             _fill(tgt)
 
             # purge de toutes les occurrences du label dans la <li>
-            _clean_li_head(li, nrm(re.sub(r'^\s*\d+\.\s*','', label_text)))
+            _clean_li_head(li, nrm(_DOTTED_NUM_RE.sub('', label_text)))
 
             if not (li.get_text(strip=True) or li.find(True)):
                 li.decompose()
@@ -781,10 +826,13 @@ def fix_section_numbering(html: str, section_key: str) -> str:
 
     # -------- 4) garde-fou : s'assurer que “1. Prix de revient” existe et est souligné --------
     if section_key == 'budget_fr':
+        final_key = nrm("1. Prix de revient")
+        residual_key = nrm("prix de revient")
+
         def _has_final_title():
             for p in soup.find_all("p"):
                 t = p.get_text(" ", strip=True)
-                if nrm(t).startswith(nrm("1. Prix de revient")):
+                if nrm(t).startswith(final_key):
                     return True
             return False
 
@@ -797,7 +845,7 @@ def fix_section_numbering(html: str, section_key: str) -> str:
         # supprimer toute ligne “Prix de revient” résiduelle non numérotée
         for node in list(soup.find_all(["p","li","em","u","strong","span"])):
             t = node.get_text(" ", strip=True)
-            if nrm(t) == nrm("prix de revient"):
+            if nrm(t) == residual_key:
                 node.decompose()
 
     # -------- 5) tuer la numérotation auto dans ces sections --------
@@ -809,15 +857,10 @@ def fix_section_numbering(html: str, section_key: str) -> str:
     
     if section_key == 'budget_fr':
         # Si "1. Prix de revient" n'apparaît nulle part (insensible à la casse/espaces), on le rajoute en tête
-        if not re.search(r'(?:^|>)\s*1\.\s*prix\s*de\s*reven[ti]', res, flags=re.I):
+        if not _PRIX_DE_REVIENT_TITLE_RE.search(res):
             res = "<p data-fixed-title='1'><em><u>1. Prix de revient</u></em></p>" + res
         # Et on supprime toute ligne "Prix de revient" orpheline (sans numéro) potentiellement laissée par Word
-        res = re.sub(
-            r'<(?:p|span|em|u|strong|a)[^>]*>\s*prix\s*de\s*reven[ti]\s*</(?:p|span|em|u|strong|a)>',
-            '',
-            res,
-            flags=re.I
-        )
+        res = _ORPHAN_PRIX_RE.sub('', res)
     
     return res
 
@@ -834,19 +877,41 @@ def apply_fixed_numbering(fr_payload: dict) -> dict:
 
 # ================= CHARGEMENT DE LA CONFIGURATION =================
 
+@st.cache_data(show_spinner=False)
+def load_yaml(path: str, mtime: float) -> Dict:
+    # mtime fait partie de la clé de cache : un fichier modifié est relu
+    return yaml.load(Path(path).read_text(encoding="utf-8"), Loader=SafeLoader) or {}
+
 def load_schema() -> Dict:
     if SCHEMA_PATH.exists():
-        return yaml.safe_load(SCHEMA_PATH.read_text(encoding="utf-8")) or DEFAULT_SCHEMA
+        return load_yaml(str(SCHEMA_PATH), SCHEMA_PATH.stat().st_mtime) or DEFAULT_SCHEMA
     return DEFAULT_SCHEMA
 
 def load_heading_map() -> Dict[str, str]:
     if MAP_PATH.exists():
-        cfg = yaml.safe_load(MAP_PATH.read_text(encoding="utf-8")) or {}
+        cfg = load_yaml(str(MAP_PATH), MAP_PATH.stat().st_mtime)
         m = cfg.get("word_to_pdf")
         if isinstance(m, dict) and m:
             return m
     return DEFAULT_HEADING_MAP
 
+@st.cache_data(show_spinner=False)
+def build_mapping_plan(field_labels: tuple, heading_pairs: tuple) -> tuple[dict, list]:
+    """
+    Plan de mapping calculé une fois par configuration :
+    titre Word -> (libellé PDF/CRM, clé CRM), et libellés PDF absents du schéma.
+    """
+    key_by_pdf_label_norm = {_norm(label): key for label, key in field_labels}
+    crm_map = {}
+    missing = []
+    for wh, pdf_label in heading_pairs:
+        k = key_by_pdf_label_norm.get(_norm(pdf_label))
+        if k:
+            crm_map[wh] = (pdf_label, k)
+        else:
+            missing.append(pdf_label)
+    return crm_map, missing
+
 def inject_css():
     st.markdown("""
     <style>
@@ -875,6 +940,60 @@ def inject_css():
     </style>
     """, unsafe_allow_html=True)
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_section_preview(key: str, raw_html: str):
+    """Nettoyage complet d'une section pour l'aperçu (mis en cache par contenu)."""
+    clean_html, dls = prepare_section_html(raw_html, strip_title=(key == "description_fr"))
+    if key == "budget_fr":
+        clean_html = force_budget_structure(clean_html)
+    return clean_html, dls
+
+@_fragment
+def render_section_previews(fields: List[Dict], fr_payload: Dict[str, str]):
+    """
+    Aperçu section par section. Fragment Streamlit : un clic sur un bouton de
+    téléchargement ne relance que ce bloc, pas la conversion du document.
+    """
+    # HTML accumulé et envoyé en un seul st.markdown, sauf autour des boutons
+    pending: List[str] = []
+
+    def _flush():
+        if pending:
+            st.markdown("".join(pending), unsafe_allow_html=True)
+            pending.clear()
+
+    for fdef in fields:
+        key = fdef["key"]
+        label = fdef["label"]
+
+        clean_html, dls = build_section_preview(key, fr_payload.get(key, ""))
+        dlmap = {uid: (fname, data, ctype) for uid, fname, data, ctype in dls}
+        # pas de commentaire HTML -> aucun jeton DL possible, pas de regex
+        parts = _DL_TOKEN_RE.split(clean_html) if "<!--" in clean_html else [clean_html]
+
+        pending.append(f"<h3>{_html_escape(label)}</h3>")
+        for idx, part in enumerate(parts):
+            if idx % 2 == 0:
+                # morceau HTML normal ; lignes vides retirées, sinon tout ce qui suit
+                # dans le même st.markdown serait rendu comme du Markdown
+                if part.strip():
+                    part = _BLANK_LINES_RE.sub("\n", part)
+                    pending.append(f"<div class='sect'>{part}</div>")
+            else:
+                # jeton DL -> bouton
+                uid = part.lower()
+                if uid in dlmap:
+                    _flush()
+                    fname, data, ctype = dlmap[uid]
+                    st.download_button(
+                        f"Télécharger {fname}",
+                        data=data,
+                        file_name=fname,
+                        mime=ctype,
+                        key=f"dl_{uid}"
+                    )
+    _flush()
+
 # ================= INTERFACE STREAMLIT =================
 
 st.set_page_config(page_title="Auto-Mapping Word", layout="wide")
@@ -886,19 +1005,13 @@ if "unsupported_images" not in st.session_state:
 
 schema = load_schema()
 fields = schema.get("fields", [])
-key_by_pdf_label_norm = {_norm(f["label"]): f["key"] for f in fields}
 nl_key_by_key = {f["key"]: f.get("nl_key") for f in fields}
 word_to_pdf = load_heading_map()
 expected_word_headings = list(word_to_pdf.keys())
 
-crm_map = {}
-missing = []
-for wh, pdf_label in word_to_pdf.items():
-    k = key_by_pdf_label_norm.get(_norm(pdf_label))
-    if k:
-        crm_map[wh] = (pdf_label, k)
-    else:
-        missing.append(pdf_label)
+crm_map, missing = build_mapping_plan(
+    tuple((f["label"], f["key"]) for f in fields), tuple(word_to_pdf.items())
+)
 
 if missing:
     st.warning("Champs non trouvés dans le schema: " + ", ".join(missing))
@@ -907,31 +1020,42 @@ st.header("1) Charger la fiche .docx")
 uploaded = st.file_uploader("Glissez le .docx ici", type=["docx"])
 
 if uploaded is not None:
-    tmp_path = Path("uploaded.docx")
-    with open(tmp_path, "wb") as f:
-        f.write(uploaded.read())
-
-    html = docx_to_html(str(tmp_path))
-    heading_index = build_heading_index(expected_word_headings, word_to_pdf)
-    sections = split_sections_by_headings(html, heading_index)
-
-    fr_payload = {}
-    rows = []
-    
-    for w_heading in expected_word_headings:
-        crm_label, crm_key = crm_map[w_heading]
-        content_html = sections.get(w_heading, "")
-        fr_payload[crm_key] = content_html
-    
-        rows.append({
-            "Word heading attendu": w_heading,
-            "Dans le .docx ?": "✅ Oui" if content_html.strip() else "❌ Non",
-            "PDF/CRM heading": crm_label,
-            "CRM key": crm_key,
-        })
-
-    # CORRECTION DE LA NUMÉROTATION
-    fr_payload = apply_fixed_numbering(fr_payload)
+    file_bytes = uploaded.getvalue()
+    file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    html, img_store = docx_to_html_cached(file_hash, file_bytes)
+    st.session_state.setdefault("img_store", {}).update(img_store)
+
+    # Mapping + numérotation recalculés seulement si le fichier ou la config change
+    # (un clic sur un widget relance le script sans rien changer ici)
+    doc_key = (file_hash, tuple(word_to_pdf.items()), tuple(crm_map.items()))
+    if st.session_state.get("_doc_key") != doc_key:
+        heading_index = build_heading_index(expected_word_headings, word_to_pdf)
+        sections = split_sections_by_headings(html, heading_index)
+        # sections non vides, calculé une fois (isspace ne recopie pas la chaîne comme strip)
+        filled = {k for k, v in sections.items() if v and not v.isspace()}
+
+        fr_payload = {}
+        rows = []
+
+        for w_heading in expected_word_headings:
+            crm_label, crm_key = crm_map[w_heading]
+            content_html = sections.get(w_heading, "")
+            fr_payload[crm_key] = content_html
+
+            rows.append({
+                "Word heading attendu": w_heading,
+                "Dans le .docx ?": "✅ Oui" if w_heading in filled else "❌ Non",
+                "PDF/CRM heading": crm_label,
+                "CRM key": crm_key,
+            })
+
+        # CORRECTION DE LA NUMÉROTATION
+        fr_payload = apply_fixed_numbering(fr_payload)
+
+        st.session_state["_doc_state"] = (sections, filled, fr_payload, rows)
+        st.session_state["_doc_key"] = doc_key
+
+    sections, filled, fr_payload, rows = st.session_state["_doc_state"]
 
     st.subheader("Résultat du mapping automatique")
     st.dataframe(rows, use_container_width=True)
@@ -940,46 +1064,13 @@ if uploaded is not None:
     with st.expander("🔍 Débogage : Sections détectées dans le HTML"):
         st.write("**Sections avec contenu :**")
         for k, v in sections.items():
-            if v.strip():
+            if k in filled:
                 st.write(f"- **{k}** : {len(v)} caractères")
         st.write("**Sections vides :**")
-        for k, v in sections.items():
-            if not v.strip():
+        for k in sections:
+            if k not in filled:
                 st.write(f"- {k}")
 
     st.header("Aperçu des sections (mise en forme préservée)")
     inject_css()
-    
-    for fdef in fields:
-        key = fdef["key"]
-        label = fdef["label"]
-    
-        raw_html = fr_payload.get(key, "")
-        if key == "description_fr":
-            raw_html = strip_leading_title_block(raw_html)
-        clean_html, dls = prepare_section_html(raw_html)
-        
-        if key == "budget_fr":
-            clean_html = force_budget_structure(clean_html)
-                
-        dlmap = {uid: (fname, data, ctype) for uid, fname, data, ctype in dls}
-        parts = re.split(r'<!--DL:([0-9a-f]+)-->', clean_html, flags=re.I)
-        
-        st.subheader(label)
-        for idx, part in enumerate(parts):
-            if idx % 2 == 0:
-                # morceau HTML normal
-                if part.strip():
-                    st.markdown(f"<div class='sect'>{part}</div>", unsafe_allow_html=True)
-            else:
-                # jeton DL -> bouton
-                uid = part.lower()
-                if uid in dlmap:
-                    fname, data, ctype = dlmap[uid]
-                    st.download_button(
-                        f"Télécharger {fname}",
-                        data=data,
-                        file_name=fname,
-                        mime=ctype,
-                        key=f"dl_{uid}"
-                    )
+    render_section_previews(fields, fr_payload)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# racine du dépôt importable (utils/...) sans installation
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,34 @@
+import io
+import struct
+import zlib
+
+import pytest
+
+pytest.importorskip("docx")
+
+from docx import Document
+
+from utils.docx_parser import _run_to_html
+
+
+def _png_1x1() -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    ihdr = struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)  # 1x1, RGB 8 bits
+    idat = zlib.compress(b"\x00\xff\x00\x00")
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", idat) + chunk(b"IEND", b"")
+
+
+def test_run_with_blip_renders_img():
+    doc = Document()
+    doc.add_picture(io.BytesIO(_png_1x1()))
+    run = doc.paragraphs[-1].runs[0]
+    html = _run_to_html(run)
+    assert html.startswith('<img src="data:image/png;base64,')
+    assert html.endswith('" />')
+
+
+def test_plain_run_renders_escaped_text():
+    doc = Document()
+    run = doc.add_paragraph().add_run("a < b & c")
+    assert _run_to_html(run) == "a &lt; b &amp; c"
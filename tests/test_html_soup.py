@@ -0,0 +1,20 @@
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("lxml")
+
+from utils.html_soup import make_soup
+
+
+def test_inline_image_over_10mb_keeps_src():
+    # > 10 Mo : au-delà de la limite d'attribut de libxml2 sans huge_tree
+    src = "data:image/png;base64," + "A" * (11 * 1024 * 1024)
+    soup = make_soup(f'<div><p>photo :</p><p><img src="{src}"/></p></div>')
+    img = soup.find("img")
+    assert img is not None
+    assert img.get("src") == src
+
+
+def test_small_fragment_unchanged():
+    soup = make_soup("<div><p>a <strong>b</strong></p></div>")
+    assert str(soup.div) == "<div><p>a <strong>b</strong></p></div>"
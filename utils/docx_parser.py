@@ -1,84 +1,129 @@
 # utils/docx_parser.py
-from typing import Dict, List, Iterator, Union
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Iterator, Union
 from docx import Document
 from docx.table import _Cell, Table
 from docx.text.paragraph import Paragraph
-from docx.oxml.table import CT_Tbl
-from docx.oxml.text.paragraph import CT_P
-import base64
+from docx.oxml.ns import qn
+import weakref
+from utils.text import strip_accents as _strip_accents, html_escape as _html_escape, data_url
 
 HEADING_STYLES = {"Heading 1","Heading 2","Heading 3","Titre 1","Titre 2","Titre 3","Title","Subtitle"}
+# puces reconnues en début de paragraphe (un seul caractère chacune)
+BULLET_CHARS = frozenset("•◦▪-–—*")
 
-def _strip_accents(x: str) -> str:
-    if x is None: return ""
-    try:
-        import unicodedata
-        nfkd = unicodedata.normalize("NFKD", x)
-        return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
-    except Exception:
-        return x
-
+@lru_cache(maxsize=4096)
 def _norm(s: str) -> str:
-    return " ".join(_strip_accents((s or "")).lower().replace("’","'").split())
-
-def _is_heading_style(p: Paragraph) -> bool:
-    s = p.style.name if getattr(p, "style", None) else ""
-    return (s in HEADING_STYLES) or s.startswith("Heading")
-
-def _looks_like_heading(text: str, p: Paragraph, expected_map: Dict[str, str]) -> bool:
+    # apostrophe courbe remplacée avant les accents : sinon elle seule force le repli NFKD
+    return " ".join(_strip_accents((s or "").replace("’","'")).lower().split())
+
+def _style_name(p: Paragraph) -> str:
+    # p.style résout le style via lxml à chaque accès : à lire une fois par paragraphe
+    return (p.style.name if getattr(p, "style", None) else "") or ""
+
+def _is_heading_style(sname: str) -> bool:
+    return (sname in HEADING_STYLES) or sname.startswith("Heading")
+
+def _expected_heading(t: str, expected_map: Dict[str, str]) -> str | None:
+    # titre attendu correspondant à t (avec ou sans ":" final), sinon None
+    nt = _norm(t)
+    if nt in expected_map:
+        return expected_map[nt]
+    # sans ":" final, la seconde forme est identique : pas de seconde normalisation
+    return expected_map.get(_norm(t.rstrip(":"))) if t.endswith(":") else None
+
+def _looks_like_heading(text: str, sname: str) -> bool:
+    # titre "libre" : style de titre sur une ligne courte sans ponctuation de phrase
     t = (text or "").strip()
     if not t: return False
-    if _norm(t) in expected_map or _norm(t.rstrip(":")) in expected_map:
-        return True
-    if _is_heading_style(p):
-        if len(t) <= 80 and t.count(" ") <= 11 and all(x not in t for x in [".","!","?"]):
-            return True
+    if len(t) <= 80 and t.count(" ") <= 11 and "." not in t and "!" not in t and "?" not in t:
+        return _is_heading_style(sname)
     return False
 
-def _html_escape(s: str) -> str:
-    return (s or "").replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
-
-def _wrap_styles(run, txt: str) -> str:
+def _match_heading(t: str, p: Paragraph, expected_map: Dict[str, str]) -> tuple[str | None, str | None]:
+    # (nom de section si titre attendu ou libre, sinon None ; nom de style s'il a été lu)
+    # le style n'est lu que hors titre attendu, et réutilisé ensuite pour les listes
+    hit = _expected_heading(t, expected_map)
+    if hit is not None:
+        return hit, None
+    sname = _style_name(p)
+    return (t if _looks_like_heading(t, sname) else None), sname
+
+@lru_cache(maxsize=64)
+def _style_tags(color: str | None, underline: bool, italic: bool, bold: bool) -> tuple[str, str]:
+    # peu de combinaisons distinctes par document : balises construites une fois
     open_tags, close_tags = "", ""
-    color = getattr(getattr(run.font, "color", None), "rgb", None)
     if color:
-        open_tags += f'<span style="color:#{str(color)}">'; close_tags = "</span>" + close_tags
-    if getattr(run, "underline", False):
+        open_tags += f'<span style="color:#{color}">'; close_tags = "</span>" + close_tags
+    if underline:
         open_tags += "<u>"; close_tags = "</u>" + close_tags
-    if getattr(run, "italic", False):
+    if italic:
         open_tags += "<em>"; close_tags = "</em>" + close_tags
-    if getattr(run, "bold", False):
+    if bold:
         open_tags += "<strong>"; close_tags = "</strong>" + close_tags
+    return open_tags, close_tags
+
+def _wrap_styles(run, txt: str) -> str:
+    # pas de <w:rPr> : ni couleur ni gras/italique/souligné direct, rien à sonder
+    if run._r.rPr is None:
+        return txt
+    color = getattr(getattr(run.font, "color", None), "rgb", None)
+    open_tags, close_tags = _style_tags(
+        str(color) if color else None,
+        bool(getattr(run, "underline", False)),
+        bool(getattr(run, "italic", False)),
+        bool(getattr(run, "bold", False)),
+    )
     return f"{open_tags}{txt}{close_tags}"
 
+# balises en notation Clark, calculées une fois (pas de xpath/dict d'espaces de noms par run)
+_A_BLIP = qn("a:blip")
+_R_EMBED = qn("r:embed")
+_W_P = qn("w:p")
+_W_TBL = qn("w:tbl")
+_W_T = qn("w:t")
+_W_BR = qn("w:br")
+
+# data URL par partie image : un logo répété n'est encodé qu'une fois (libéré avec le document)
+_DATAURL_BY_PART = weakref.WeakKeyDictionary()
+
 def _run_image_dataurl(run) -> str | None:
     try:
-        ns = {"a":"http://schemas.openxmlformats.org/drawingml/2006/main",
-              "r":"http://schemas.openxmlformats.org/officeDocument/2006/relationships"}
-        blips = run._r.xpath(".//a:blip/@r:embed", namespaces=ns)
-        if not blips: return None
-        part = run.part.related_parts[blips[0]]
+        rid = None
+        for blip in run._r.iter(_A_BLIP):  # en pratique 0 ou 1 blip par run
+            rid = blip.get(_R_EMBED)
+            if rid: break
+        if not rid: return None
+        part = run.part.related_parts[rid]
+        cached = _DATAURL_BY_PART.get(part)
+        if cached is not None:
+            return cached
         ctype = getattr(part, "content_type", "image/png")
-        b64 = base64.b64encode(part.blob).decode("ascii")
-        return f"data:{ctype};base64,{b64}"
+        dataurl = _DATAURL_BY_PART[part] = data_url(ctype, part.blob)
+        return dataurl
     except Exception:
         return None
 
 def _run_to_html(run) -> str:
-    # On parcourt les enfants du run pour capter <w:t> (texte) et <w:br/> (saut de ligne)
-    frags: List[str] = []
+    # cas courant : run sans mise en forme avec un seul <w:t> (ni image ni saut de ligne)
+    r = run._r
+    if r.rPr is None and len(r) == 1 and r[0].tag == _W_T:
+        return _html_escape(r[0].text or "")
+
     dataurl = _run_image_dataurl(run)
     if dataurl:
-        frags.append(f'<img src="{dataurl}" />')
-        return "".join(frags)
+        return f'<img src="{dataurl}" />'
 
+    # On parcourt les enfants du run pour capter <w:t> (texte) et <w:br/> (saut de ligne)
+    frags: List[str] = []
     for child in run._r.iterchildren():
         tag = child.tag
-        if tag.endswith("}t"):  # texte
+        if tag == _W_T:  # texte
             txt = _html_escape(child.text or "")
             if txt:
                 frags.append(_wrap_styles(run, txt))
-        elif tag.endswith("}br"):  # saut de ligne dans le même paragraphe
+        elif tag == _W_BR:  # saut de ligne dans le même paragraphe
             frags.append("<br/>")
         # (on ignore les autres éléments)
     # fallback si pas d’enfants exploitables
@@ -88,33 +133,39 @@ def _run_to_html(run) -> str:
             frags.append(_wrap_styles(run, txt))
     return "".join(frags)
 
-def _para_list_kind(p: Paragraph, text: str) -> str | None:
+def _para_list_kind(p: Paragraph, text: str, sname: str) -> str | None:
     pPr = getattr(p._p, "pPr", None)
     if getattr(pPr, "numPr", None) is not None:
-        sname = (p.style.name if getattr(p, "style", None) else "") or ""
         if "Number" in sname:
             return "ol"
         if text and (text[:3].strip().rstrip(".)").isdigit()):
             return "ol"
         return "ul"
-    sname = (p.style.name if getattr(p, "style", None) else "") or ""
-    if any(k in sname for k in ["List","Puces","Bullet"]): return "ul"
+    if "List" in sname or "Puces" in sname or "Bullet" in sname: return "ul"
     if "Number" in sname: return "ol"
     start = (text or "").lstrip()
-    if start.startswith(("•","◦","▪","-","–","—","*")): return "ul"
+    if start[:1] in BULLET_CHARS: return "ul"
     return None
 
-def _para_to_html(p: Paragraph) -> tuple[str, str]:
-    inner = "".join(_run_to_html(r) for r in p.runs) or _html_escape(p.text or "")
-    kind = _para_list_kind(p, p.text or "")
-    if kind == "ol":
-        return ("li-ol", f"<li>{inner}</li>")
-    if kind == "ul":
-        for b in ("•","◦","▪","-","–","—","*"):
-            if inner.startswith(b):
-                inner = inner[len(b):].lstrip(); break
-        return ("li-ul", f"<li>{inner}</li>")
-    return ("p", f"<p>{inner}</p>")
+# type de liste -> (étiquette du fragment, balise ouvrante, balise fermante)
+_FRAG_FMT = {
+    "ol": ("li-ol", "<li>", "</li>"),
+    "ul": ("li-ul", "<li>", "</li>"),
+    None: ("p", "<p>", "</p>"),
+}
+
+def _para_to_html(p: Paragraph, text: str | None = None, sname: str | None = None) -> tuple[str, str]:
+    # text / sname : p.text et nom de style déjà calculés par l'appelant
+    if text is None:
+        text = p.text or ""
+    if sname is None:
+        sname = _style_name(p)
+    inner = "".join(_run_to_html(r) for r in p.runs) or _html_escape(text)
+    kind = _para_list_kind(p, text, sname)
+    if kind == "ul" and inner[:1] in BULLET_CHARS:
+        inner = inner[1:].lstrip()
+    label, open_tag, close_tag = _FRAG_FMT[kind]
+    return (label, f"{open_tag}{inner}{close_tag}")
 
 def iter_block_items(parent) -> Iterator[Union[Paragraph, Table]]:
     if isinstance(parent, _Cell):
@@ -122,17 +173,20 @@ def iter_block_items(parent) -> Iterator[Union[Paragraph, Table]]:
     else:
         parent_elm = parent._element
     for child in parent_elm.iterchildren():
-        if isinstance(child, CT_P):
+        tag = child.tag
+        if tag == _W_P:
             yield Paragraph(child, parent)
-        elif isinstance(child, CT_Tbl):
+        elif tag == _W_TBL:
             yield Table(child, parent)
 
-def parse_docx_sections(path, expected_headings: List[str] = None) -> Dict[str, str]:
-    doc = Document(path)
+def parse_docx_sections(source: Union[str, Path, BinaryIO], expected_headings: List[str] = None) -> Dict[str, str]:
+    # python-docx accepte un chemin ou un flux binaire (ex. io.BytesIO(uploaded.getvalue()))
+    doc = Document(source)
     expected_map = {_norm(h): h for h in (expected_headings or [])}
     expected_map.update({_norm(h.rstrip(":")): h for h in (expected_headings or [])})
 
-    sections: Dict[str, str] = {}
+    # fragments par section, joints une seule fois à la fin (pas de concaténation répétée)
+    sections: Dict[str, List[str]] = {}
     current = None
     html_chunks: List[str] = []
     in_list = False
@@ -146,17 +200,19 @@ def parse_docx_sections(path, expected_headings: List[str] = None) -> Dict[str,
         if current and html_chunks:
             html = "".join(html_chunks).strip()
             if html:
-                sections[current] = (sections.get(current,"") + html)
+                sections.setdefault(current, []).append(html)
         html_chunks = []
 
     for block in iter_block_items(doc):
         if isinstance(block, Paragraph):
-            t = (block.text or "").strip()
-            if t and _looks_like_heading(t, block, expected_map):
+            raw = block.text or ""
+            t = raw.strip()
+            heading, sname = _match_heading(t, block, expected_map) if t else (None, None)
+            if heading is not None:
                 flush()
-                current = expected_map.get(_norm(t), expected_map.get(_norm(t.rstrip(":")), t))
+                current = heading
                 continue
-            kind, frag = _para_to_html(block)
+            kind, frag = _para_to_html(block, raw, sname)
             if kind == "p":
                 if in_list:
                     html_chunks.append(f"</{list_kind}>")
@@ -174,23 +230,26 @@ def parse_docx_sections(path, expected_headings: List[str] = None) -> Dict[str,
             if in_list:
                 html_chunks.append(f"</{list_kind}>")
                 in_list = False; list_kind = None
-            rows = []
+            # écrit directement dans le tampon de la section (pas de listes par ligne/cellule)
+            html_chunks.append(
+                "<table border='1' cellspacing='0' cellpadding='6' style='border-collapse:collapse;width:100%'>"
+            )
             for row in block.rows:
-                tds = []
+                html_chunks.append("<tr>")
                 for cell in row.cells:
-                    cell_parts = []
+                    html_chunks.append("<td>")
+                    n = len(html_chunks)
                     for pp in cell.paragraphs:
                         k, frag = _para_to_html(pp)
                         if k.startswith("li"):
-                            cell_parts.append(f"<ul>{frag}</ul>")
+                            html_chunks.append(f"<ul>{frag}</ul>")
                         else:
-                            cell_parts.append(frag)
-                    tds.append(f"<td>{''.join(cell_parts) or '&nbsp;'}</td>")
-                rows.append(f"<tr>{''.join(tds)}</tr>")
-            html_chunks.append(
-                "<table border='1' cellspacing='0' cellpadding='6' style='border-collapse:collapse;width:100%'>"
-                + "".join(rows) + "</table>"
-            )
+                            html_chunks.append(frag)
+                    if len(html_chunks) == n:  # cellule sans paragraphe
+                        html_chunks.append("&nbsp;")
+                    html_chunks.append("</td>")
+                html_chunks.append("</tr>")
+            html_chunks.append("</table>")
 
     flush()
-    return sections
+    return {k: "".join(v) for k, v in sections.items()}
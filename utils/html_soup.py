@@ -0,0 +1,16 @@
+# utils/html_soup.py
+from bs4 import BeautifulSoup
+
+try:
+    import lxml  # noqa: F401  (backend C de BeautifulSoup)
+    _HAS_LXML = True
+except ImportError:
+    _HAS_LXML = False  # html.parser (pur Python, sans limite de taille)
+
+def make_soup(markup: str) -> BeautifulSoup:
+    """Parse un fragment HTML avec lxml (huge_tree) si disponible, sinon html.parser."""
+    if _HAS_LXML:
+        # sans huge_tree, libxml2 tronque les attributs > 10 Mo : une image inline
+        # (data:...;base64) de plus de ~7,5 Mo perdrait son src
+        return BeautifulSoup(markup, "lxml", huge_tree=True)
+    return BeautifulSoup(markup, "html.parser")
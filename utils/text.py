@@ -0,0 +1,33 @@
+# utils/text.py
+import base64
+import unicodedata
+
+def _nfkd_strip(x: str) -> str:
+    nfkd = unicodedata.normalize("NFKD", x)
+    return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
+
+# Latin-1 + Latin étendu A -> forme sans accent, dérivée de NFKD (même résultat, mais en C)
+_ACCENT_TABLE = {ord(c): _nfkd_strip(c) for c in map(chr, range(0xA0, 0x180)) if _nfkd_strip(c) != c}
+
+def strip_accents(x: str) -> str:
+    if x is None: return ""
+    try:
+        t = x.translate(_ACCENT_TABLE)
+        return t if t.isascii() else _nfkd_strip(t)
+    except Exception:
+        return x
+
+def html_escape(s: str) -> str:
+    s = s or ""
+    # cas courant : rien à échapper, la chaîne est rendue telle quelle
+    if "&" not in s and "<" not in s and ">" not in s:
+        return s
+    return s.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+
+def data_url(ctype: str, data: bytes) -> str:
+    # un seul tampon ASCII, sans chaîne base64 intermédiaire ni f-string
+    buf = bytearray(b"data:")
+    buf += ctype.encode("ascii")
+    buf += b";base64,"
+    buf += base64.b64encode(data)
+    return buf.decode("ascii")